@@ -1,23 +1,30 @@
 from fastapi import APIRouter, HTTPException, Query, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import xarray as xr
+import h5netcdf
 import numpy as np
 import matplotlib
 # Use Agg backend immediately to prevent server GUI errors
 matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
+# Figure objects (not pyplot's global state) so handlers can render in parallel threads
+from matplotlib.figure import Figure
 import matplotlib.patches as patches
 from matplotlib.collections import PatchCollection
 from geojson import Feature, FeatureCollection, MultiPolygon
 from scipy.ndimage import gaussian_filter
 import os
 import io
+import orjson
 
 # --- PROJECT IMPORTS ---
 from app.services import gpm_service 
+from app.utils import plotting
 
 router = APIRouter()
 
+# Handlers are plain `def`: FastAPI runs them on its threadpool, so the blocking
+# HDF5 / NumPy / matplotlib work overlaps across requests instead of stalling the event loop
+
 # Thresholds for rain intensity (mm/hr)
 LEVELS = [0.1, 0.5, 5.0, 10.0, 20.0]
 
@@ -33,11 +40,16 @@ def _load_and_process_gpm(filename: str, bounds: dict):
     if not os.path.exists(file_path):
         raise FileNotFoundError("File not found")
 
-    # A. Open Dataset
+    # A. Open Dataset (single open: probe for the 'Grid' group on the same handle
+    # instead of failing on it and re-opening the file from scratch)
+    nc = h5netcdf.File(file_path, 'r')
     try:
-        ds = xr.open_dataset(file_path, engine='h5netcdf', group='Grid', decode_times=False)
-    except OSError:
-        ds = xr.open_dataset(file_path, engine='h5netcdf', decode_times=False)
+        store = xr.backends.H5NetCDFStore(nc, group='Grid' if 'Grid' in nc.groups else None)
+        ds = xr.open_dataset(store, decode_times=False)
+    except Exception:
+        # The dataset owns the handle only once opened; don't leak it on failure
+        nc.close()
+        raise
 
     # B. Identify Variable
     if 'precipitation' in ds:
@@ -98,7 +110,7 @@ def _load_and_process_gpm(filename: str, bounds: dict):
 # 2. MAIN ENDPOINT
 # ==========================================
 @router.get("/")
-async def get_gpm_data(
+def get_gpm_data(
     filename: str = Query(...),
     toplat: float = Query(...),
     bottomlat: float = Query(...),
@@ -128,7 +140,8 @@ async def get_gpm_data(
             features = []
             
             # Use matplotlib to calculate contours purely mathematically (no visible plot)
-            fig, ax = plt.subplots()
+            fig = Figure()
+            ax = fig.subplots()
             
             for level in LEVELS:
                 if np.max(smooth_data) < level: continue
@@ -156,7 +169,6 @@ async def get_gpm_data(
                             properties={"level": level}
                         ))
             
-            plt.close(fig)
             ds.close()
             return JSONResponse(content=FeatureCollection(features))
 
@@ -164,7 +176,8 @@ async def get_gpm_data(
         # MODE B: PLOT (Image)
         # ==========================
         elif draw == "plot":
-            fig, ax = plt.subplots(figsize=(10, 8), dpi=100)
+            fig = Figure(figsize=(10, 8), dpi=100)
+            ax = fig.subplots()
             
             # 1. Raw Data Scatter (Blue Dots)
             xx, yy = np.meshgrid(lons, lats)
@@ -191,9 +204,8 @@ async def get_gpm_data(
             
             # Save to Buffer
             buf = io.BytesIO()
-            plt.savefig(buf, format='png', transparent=True, bbox_inches='tight', pad_inches=0)
+            fig.savefig(buf, format='png', transparent=True, bbox_inches='tight', pad_inches=0)
             buf.seek(0)
-            plt.close(fig)
             ds.close()
             
             return Response(content=buf.getvalue(), media_type="image/png")
@@ -206,9 +218,84 @@ async def get_gpm_data(
 
 
 # ==========================================
-# 3. UTILITY ENDPOINTS
+# 3. HEATMAP ENDPOINT
+# ==========================================
+@router.get("/plot")
+def plot_gpm_file(
+    filename: str = Query(...),
+    toplat: float = Query(...),
+    bottomlat: float = Query(...),
+    leftlon: float = Query(...),
+    rightlon: float = Query(...),
+    width: int = Query(1024, ge=16, le=4096, description="Image width (px); capped with height at 4 MP")
+):
+    """
+    Transparent PNG heatmap of the cropped grid (fast raster, no matplotlib figure).
+    """
+    bounds = {'top': toplat, 'bottom': bottomlat, 'left': leftlon, 'right': rightlon}
+    try:
+        lats, lons, data = gpm_service.process_local_file(filename, bounds)
+        img_bytes = plotting.generate_heatmap_fast(lats, lons, data, bounds, width=width)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    return Response(content=img_bytes, media_type="image/png")
+
+# ==========================================
+# 4. SPARSE DATA ENDPOINT
+# ==========================================
+# Binary bodies are streamed in slices: a single send() of a large body leaves the
+# unsent remainder copied into the transport buffer (a second full copy in RAM)
+STREAM_CHUNK_BYTES = 1 << 20
+
+def _iter_slices(buf, size=STREAM_CHUNK_BYTES):
+    """Zero-copy memoryview slices of buf."""
+    view = memoryview(buf)
+    for i in range(0, len(view), size):
+        yield view[i:i + size]
+
+@router.get("/data")
+def get_sparse_data(
+    filename: str = Query(...),
+    toplat: float = Query(...),
+    bottomlat: float = Query(...),
+    leftlon: float = Query(...),
+    rightlon: float = Query(...),
+    threshold: float = Query(0.1, description="Minimum rain rate (mm/hr)"),
+    format: str = Query("json", enum=["json", "bin"], description="Output encoding"),
+    compress: bool = Query(False, description="Blosc2/Zstd-compress the binary payload")
+):
+    """
+    Sparse points where rain > threshold.
+    - format='json': Columnar { lats, lons, vals, latlon_scale, val_scale, stats }
+      (fixed-point ints, divide by the scales)
+    - format='bin': Quantized binary (see gpm_service.get_binary_cloud_data for layout)
+      with compress=true the body is a single Blosc2 chunk, not a frame (application/x-blosc2)
+    """
+    bounds = {'top': toplat, 'bottom': bottomlat, 'left': leftlon, 'right': rightlon}
+    try:
+        if format == "bin":
+            body = gpm_service.get_binary_cloud_data(filename, bounds, threshold, compress)
+            if compress:
+                return Response(content=body, media_type="application/x-blosc2")
+            return StreamingResponse(_iter_slices(body), media_type="application/octet-stream",
+                                     headers={"Content-Length": str(len(body))})
+
+        data = gpm_service.get_sparse_cloud_data(filename, bounds, threshold)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    # orjson serializes the float32 ndarrays directly (no tolist() round-trip)
+    return Response(content=orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY), media_type="application/json")
+
+# ==========================================
+# 5. UTILITY ENDPOINTS
 # ==========================================
 @router.get("/files")
-async def list_files():
+def list_files():
     """List available HDF5 files."""
     return gpm_service.list_available_files()
\ No newline at end of file
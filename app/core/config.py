@@ -8,4 +8,8 @@ DATA_DIR = os.path.join(BASE_DIR, "app", "data")
 
 # Ensure dirs exist
 os.makedirs(TEMP_DIR, exist_ok=True)
-os.makedirs(DATA_DIR, exist_ok=True)
\ No newline at end of file
+os.makedirs(DATA_DIR, exist_ok=True)
+# GPM read caches (memory budget: worst case pins GPM_MAX_OPEN_FILES x GPM_CHUNK_CACHE_MB
+# of decompressed chunks, i.e. 8 x 32 MB = 256 MB with the defaults)
+GPM_MAX_OPEN_FILES = int(os.environ.get("GPM_MAX_OPEN_FILES", 8))
+GPM_CHUNK_CACHE_MB = int(os.environ.get("GPM_CHUNK_CACHE_MB", 32))
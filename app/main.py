@@ -1,8 +1,16 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.routers import dashboard, weather, gpm
+from app.services import gpm_service
 
-app = FastAPI(title="Unified Weather Processor")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # Shutdown: close the GPM file handles cached across requests
+    gpm_service.close_cached_datasets()
+
+app = FastAPI(title="Unified Weather Processor", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -0,0 +1,115 @@
+import os
+import threading
+import contextlib
+import numpy as np
+
+# Numba is optional: the NumPy implementation at the bottom has the same contract.
+# It is used when numba isn't installed, or when GPM_DISABLE_NUMBA=1 is set to
+# skip numba's import and JIT cost (e.g. short-lived workers, small crops only).
+HAVE_NUMBA = False
+if os.environ.get('GPM_DISABLE_NUMBA', '0') != '1':
+    try:
+        from numba import config, njit, prange, threading_layer
+        HAVE_NUMBA = True
+    except ImportError:
+        pass
+
+# Full fastmath implies 'nnan', which would let LLVM fold away the NaN checks
+# in the comparisons below (grids may contain NaN fill values).
+FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
+
+# Files are opened without CF masking, so fill sentinels reach the filter raw.
+# The file's _FillValue is passed in and rejected explicitly (the threshold is user
+# input, so it can't be relied on to exclude it); this also rejects unflagged huge ones.
+FILL_CEILING = 1e20
+
+def _filter_grid_jit(data, lats, lons, thr, fill, out_lat, out_lon, out_val):
+    """
+    Fused threshold + gather over a (lat, lon) grid.
+    Writes every cell where thr < data < FILL_CEILING and data != fill into
+    out_lat/out_lon/out_val (row-major order) and returns (count, max_val).
+    Outputs must hold at least data.size elements. Pass fill=NaN if the file has none.
+    Rows are split across threads (prange) and the GIL is released for the whole call,
+    so concurrent requests overlap instead of queueing behind each other.
+    """
+    n_rows, n_cols = data.shape
+    ceiling = data.dtype.type(FILL_CEILING)
+
+    # Pass 1: Count survivors per row.
+    # Branchless (mask added as 0/1) so LLVM vectorizes it into SIMD compares + adds;
+    # this is the only pass that touches every cell.
+    counts = np.zeros(n_rows, dtype=np.int64)
+    for y in prange(n_rows):
+        c = np.int32(0)
+        for x in range(n_cols):
+            v = data[y, x]
+            c += np.int32((v > thr) & (v < ceiling) & (v != fill))
+        counts[y] = c
+
+    # Per-row write offsets (exclusive cumsum)
+    offsets = np.empty(n_rows, dtype=np.int64)
+    total = 0
+    for y in range(n_rows):
+        offsets[y] = total
+        total += counts[y]
+
+    # Pass 2: Each row writes into its own slot (race-free), tracking the max of
+    # its survivors, and stops at its last survivor instead of scanning the full row
+    row_max = np.full(n_rows, -np.inf, dtype=np.float32)
+    for y in prange(n_rows):
+        w = offsets[y]
+        end = w + counts[y]
+        m = row_max[y]
+        lat = lats[y]
+        x = 0
+        while w < end:
+            v = data[y, x]
+            if (v > thr) & (v < ceiling) & (v != fill):
+                out_lat[w] = lat
+                out_lon[w] = lons[x]
+                out_val[w] = v
+                w += 1
+                if v > m: m = v
+            x += 1
+        row_max[y] = m
+
+    max_val = row_max.max() if n_rows > 0 else -np.inf
+    return total, max_val
+
+def _filter_grid_numpy(data, lats, lons, thr, fill, out_lat, out_lon, out_val):
+    """NumPy version of filter_grid (mask scan + gathers, max over the survivors)."""
+    y_idxs, x_idxs = np.nonzero((data > thr) & (data < FILL_CEILING) & (data != fill))
+    count = len(y_idxs)
+    out_val[:count] = data[y_idxs, x_idxs]
+    out_lat[:count] = lats[y_idxs]
+    out_lon[:count] = lons[x_idxs]
+    max_val = out_val[:count].max() if count > 0 else -np.inf
+    return count, max_val
+
+if HAVE_NUMBA:
+    # Kernels are launched from server worker threads: OpenMP first, since TBB can hang
+    # interpreter shutdown in that case.
+    config.THREADING_LAYER_PRIORITY = ['omp', 'tbb', 'workqueue']
+    _filter_grid_parallel = njit(parallel=True, nogil=True, fastmath=FASTMATH, cache=True)(_filter_grid_jit)
+
+    # If neither OpenMP nor TBB loads, numba silently falls back to workqueue, which
+    # aborts the process when two threads launch a parallel region at once. The layer
+    # is only known after the first launch, so that call runs under the init lock and
+    # later calls serialize only if workqueue was picked.
+    _layer_init_lock = threading.Lock()
+    _layer_guard = None
+
+    def filter_grid(data, lats, lons, thr, fill, out_lat, out_lon, out_val):
+        global _layer_guard
+        if _layer_guard is None:
+            with _layer_init_lock:
+                if _layer_guard is None:
+                    result = _filter_grid_parallel(data, lats, lons, thr, fill, out_lat, out_lon, out_val)
+                    _layer_guard = threading.Lock() if threading_layer() == 'workqueue' else contextlib.nullcontext()
+                    return result
+        with _layer_guard:
+            return _filter_grid_parallel(data, lats, lons, thr, fill, out_lat, out_lon, out_val)
+
+    filter_grid.__doc__ = _filter_grid_jit.__doc__
+else:
+    filter_grid = _filter_grid_numpy
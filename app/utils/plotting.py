@@ -1,5 +1,6 @@
 import io
 import numpy as np
+from PIL import Image
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
@@ -102,4 +103,75 @@ def generate_debug_heatmap(lats, lons, data, bounds, polygons=None):
     plt.savefig(buf, format='png', bbox_inches='tight', dpi=100)
     buf.seek(0)
     plt.close(fig)
-    return buf.getvalue()
\ No newline at end of file
+    return buf.getvalue()
+
+# 256-entry RGBA lookup table, built once; colorizing is then a single take()
+_RAIN_LUT = matplotlib.colormaps['turbo'](np.linspace(0, 1, 256), bytes=True)
+
+def _cell_index(centers, coords, lo, hi):
+    """
+    Index of the grid cell containing each coord (-1 if outside), centers ascending.
+    lo/hi is the canvas extent: a lone center has no spacing to size its cell from,
+    so it is stretched to cover the whole canvas (it is the only cell inside it).
+    """
+    mids = (centers[1:] + centers[:-1]) / 2
+    if len(centers) == 1:
+        half = max(centers[0] - lo, hi - centers[0], 0)
+    else:
+        half = (centers[-1] - centers[0]) / (2 * (len(centers) - 1))
+    edges = np.concatenate(([centers[0] - half], mids, [centers[-1] + half]))
+    idx = np.searchsorted(edges, coords, side='right') - 1
+    idx[(idx < 0) | (idx >= len(centers))] = -1
+    return idx
+
+# Canvas budget: a tall, narrow crop at a large width would otherwise ask for up to
+# 4096 x 16384 px (~4 s and >2 GB per request)
+HEATMAP_MAX_PIXELS = 4 * 2**20
+
+def generate_heatmap_fast(lats, lons, data, bounds, width=1024, vmin=0.1, vmax=50.0):
+    """
+    Fast overlay: rasterizes the (lat, lon) grid straight onto a width-pixel canvas
+    spanning bounds, colorizes via a LUT (log scale vmin..vmax mm/hr) and encodes PNG.
+    Dry (<= vmin), NaN and out-of-grid pixels are transparent. No matplotlib figure.
+    Canvases over HEATMAP_MAX_PIXELS are scaled down (aspect kept).
+    """
+    # 1. Ascending axes (flip data to match)
+    if lats[0] > lats[-1]:
+        lats, data = lats[::-1], data[::-1, :]
+    if lons[0] > lons[-1]:
+        lons, data = lons[::-1], data[:, ::-1]
+
+    # 2. Canvas: pixel centers in map coordinates (row 0 = north)
+    left, right = min(bounds['left'], bounds['right']), max(bounds['left'], bounds['right'])
+    bottom, top = min(bounds['bottom'], bounds['top']), max(bounds['bottom'], bounds['top'])
+    height = int(np.clip(round(width * (top - bottom) / max(right - left, 1e-6)), 1, 4 * width))
+    if width * height > HEATMAP_MAX_PIXELS:
+        shrink = (HEATMAP_MAX_PIXELS / (width * height)) ** 0.5
+        width, height = max(int(width * shrink), 1), max(int(height * shrink), 1)
+    px_lon = left + (np.arange(width) + 0.5) * (right - left) / width
+    px_lat = top - (np.arange(height) + 0.5) * (top - bottom) / height
+
+    # 3. Nearest-cell gather (one fancy-index for the whole canvas)
+    iy = _cell_index(lats, px_lat, bottom, top)
+    ix = _cell_index(lons, px_lon, left, right)
+    vals = data[iy[:, None], ix[None, :]]
+    vals[iy < 0, :] = np.nan
+    vals[:, ix < 0] = np.nan
+
+    # 4. Colorize: log-normalize into LUT indices, transparent where dry/missing.
+    # In place on the gathered canvas (it is a fresh copy): no full-size temporaries
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wet = vals > vmin
+        np.divide(vals, vmin, out=vals)
+        np.log(vals, out=vals)
+        np.divide(vals, np.log(vmax / vmin), out=vals)
+    np.nan_to_num(vals, copy=False)
+    np.clip(vals, 0, 1, out=vals)
+    np.multiply(vals, 255, out=vals)
+    rgba = _RAIN_LUT[vals.astype(np.uint8)]
+    rgba[~wet, 3] = 0
+
+    # 5. Encode (low zlib level: speed over a few % of size)
+    buf = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buf, format='PNG', compress_level=1)
+    return buf.getvalue()